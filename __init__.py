@@ -40,9 +40,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import re
-import random
+import time
 
+from collections import OrderedDict
 from adapt.intent import IntentBuilder
 from neon_utils.skills.neon_skill import NeonSkill, LOG
 from os.path import join, exists
@@ -53,16 +53,27 @@ from mycroft.skills.core import intent_handler
 from mycroft.skills.audioservice import AudioService
 
 STATUS_KEYS = ['track', 'artist', 'album', 'image']
+RESOLUTION_CACHE_SIZE = 32  # max phrases remembered for repeat queries
+RESOLUTION_CACHE_TTL = 60   # seconds a phrase resolution stays valid
+MAX_PENDING_QUERIES = 16    # unresolved play queries kept at once
+QUERY_DEADLINE_EPSILON = 0.25  # seconds of slack before rescheduling
 
 
 class PlaybackControlSkill(NeonSkill):
     def __init__(self):
         super(PlaybackControlSkill, self).__init__('Playback Control Skill')
-        self.query_replies = {}     # cache of received replies
-        self.query_extensions = {}  # maintains query timeout extensions
+        self.query_replies = OrderedDict()     # cache of received replies
+        self.query_extensions = OrderedDict()  # query timeout extensions
         self.audio_service = None
         self.has_played = False
         self.lock = Lock()
+        self._query_deadline = {}   # phrase -> monotonic query timeout
+        self._scheduled_deadline = {}  # phrase -> when the timer will fire
+        self._last_status = {k: None for k in STATUS_KEYS}  # gui shadow
+        self._voc_path_cache = {}   # (lang, voc_filename) -> path or None
+        self._voc_max_len = {}      # voc cache_key -> longest entry length
+        # (username, phrase) -> (monotonic timestamp, selected resolution)
+        self._resolution_cache = OrderedDict()
 
     # TODO: Make this an option for voc_match()?  Only difference is the
     #       comparison using "==" instead of "in"
@@ -89,24 +100,105 @@ class PlaybackControlSkill(NeonSkill):
         cache_key = lang + voc_filename
 
         if cache_key not in self.voc_match_cache:
-            # Check for both skill resources and mycroft-core resources
-            voc = self.find_resource(voc_filename + '.voc', 'vocab')
-            if not voc:
-                voc = resolve_resource_file(join('text', lang,
-                                                 voc_filename + '.voc'))
+            path_key = (lang, voc_filename)
+            if path_key not in self._voc_path_cache:
+                # Check for both skill resources and mycroft-core resources
+                voc = self.find_resource(voc_filename + '.voc', 'vocab')
+                if not voc:
+                    voc = resolve_resource_file(join('text', lang,
+                                                     voc_filename + '.voc'))
+                # Cache misses too so a missing file isn't probed again
+                self._voc_path_cache[path_key] = \
+                    voc if voc and exists(voc) else None
+            voc = self._voc_path_cache[path_key]
 
-            if not voc or not exists(voc):
+            if not voc:
                 raise FileNotFoundError(
                         'Could not find {}.voc file'.format(voc_filename))
 
             with open(voc) as f:
-                self.voc_match_cache[cache_key] = f.read().splitlines()
+                vocab = frozenset(line.strip() for line in f if line.strip())
+            self.voc_match_cache[cache_key] = vocab
+            self._voc_max_len[cache_key] = max(map(len, vocab), default=0)
 
-        # Check for exact match
-        if utt and any(i.strip() == utt
-                       for i in self.voc_match_cache[cache_key]):
-            return True
-        return False
+        # Utterances longer than any entry can't be an exact match
+        if not utt or len(utt) > self._voc_max_len.get(cache_key, len(utt)):
+            return False
+        return utt in self.voc_match_cache[cache_key]
+
+    @staticmethod
+    def _resolution_key(message, phrase):
+        """Resolution cache key; resolutions are never shared between users."""
+        return message.context.get("username"), phrase
+
+    def _get_cached_resolution(self, message, phrase):
+        """Return a recent resolution of phrase for the requesting user, if
+        still valid.
+
+        Callers must hold self.lock.
+        """
+        key = self._resolution_key(message, phrase)
+        cached = self._resolution_cache.get(key)
+        if not cached:
+            return None
+        timestamp, resolution = cached
+        if time.monotonic() - timestamp > RESOLUTION_CACHE_TTL:
+            del self._resolution_cache[key]
+            return None
+        self._resolution_cache.move_to_end(key)
+        return resolution
+
+    def _cache_resolution(self, message, phrase, skill_id, callback_data):
+        """Remember which skill handled phrase for the requesting user.
+
+        Callers must hold self.lock.
+        """
+        key = self._resolution_key(message, phrase)
+        self._resolution_cache[key] = (time.monotonic(),
+                                       {"skill_id": skill_id,
+                                        "callback_data": callback_data})
+        self._resolution_cache.move_to_end(key)
+        while len(self._resolution_cache) > RESOLUTION_CACHE_SIZE:
+            self._resolution_cache.popitem(last=False)
+
+    def _start_query(self, phrase):
+        """Reset query state for phrase, dropping the oldest pending queries
+        if there are too many."""
+        self.query_replies[phrase] = []
+        self.query_replies.move_to_end(phrase)
+        self.query_extensions[phrase] = set()
+        self.query_extensions.move_to_end(phrase)
+        while len(self.query_replies) > MAX_PENDING_QUERIES:
+            stale, _ = self.query_replies.popitem(last=False)
+            LOG.warning("Dropping unresolved play query: {}".format(stale))
+            self.query_extensions.pop(stale, None)
+            self._query_deadline.pop(stale, None)
+            if self._scheduled_deadline.pop(stale, None) is not None:
+                self.cancel_scheduled_event(self._query_timeout_name(stale))
+
+    @staticmethod
+    def _query_timeout_name(phrase):
+        """Scheduled event name for the given phrase's query timeout."""
+        return 'PlayQueryTimeout:' + phrase
+
+    def _set_query_timeout(self, phrase, delay):
+        """Set the play query for phrase to time out delay seconds from now.
+
+        The scheduled event is only replaced when the deadline moves earlier;
+        a later deadline is picked up by _play_query_timeout when the existing
+        event fires.
+        """
+        deadline = time.monotonic() + delay
+        self._query_deadline[phrase] = deadline
+        scheduled = self._scheduled_deadline.get(phrase)
+        if scheduled is not None:
+            if scheduled - deadline <= QUERY_DEADLINE_EPSILON:
+                return
+            self.cancel_scheduled_event(self._query_timeout_name(phrase))
+        self.schedule_event(self._play_query_timeout, delay,
+                            data={"phrase": phrase},
+                            name=self._query_timeout_name(phrase))
+        self._scheduled_deadline[phrase] = deadline
 
     def initialize(self):
         self.audio_service = AudioService(self.bus)
@@ -130,6 +222,7 @@ class PlaybackControlSkill(NeonSkill):
         # Initialize track info variables
         for k in STATUS_KEYS:
             self.gui[k] = ''
+        self._last_status = {k: '' for k in STATUS_KEYS}
 
     @intent_handler(IntentBuilder('NextTrack').require('Next').require("Track"))
     def handle_next(self, message):
@@ -155,6 +248,8 @@ class PlaybackControlSkill(NeonSkill):
     def stop(self, message=None):
         self.clear_gui_info()
         self.gui.clear()
+        # gui.clear() drops the track keys; the next status must rewrite them
+        self._last_status = {k: None for k in STATUS_KEYS}
         LOG.info('Audio service status: '
                  '{}'.format(self.audio_service.track_info()))
         if self.audio_service.is_playing:
@@ -165,8 +260,9 @@ class PlaybackControlSkill(NeonSkill):
 
     def converse(self, message=None):
         utterances = message.data.get("utterances")
-        if (utterances and self.has_played and
-                self.voc_match_exact(utterances[0], "converse_resume")):
+        utt = utterances[0] if utterances else None
+        if (utt and self.has_played and
+                self.voc_match_exact(utt, "converse_resume")):
             # NOTE:  voc_match() will overmatch (e.g. it'll catch "play next
             #        song" or "play Some Artist")
             self.audio_service.resume()
@@ -193,7 +289,22 @@ class PlaybackControlSkill(NeonSkill):
         # This really just hacks around limitations of the Adapt regex system,
         # which will only return the first word of the target phrase
         utt = message.data.get('utterance')
-        phrase = re.sub('^.*?' + message.data['Play'], '', utt).strip()
+        play_kw = message.data['Play']
+        idx, kw_len = utt.find(play_kw), len(play_kw)
+        if idx < 0 and len(utt.lower()) == len(utt):
+            # Only match case-insensitively when indices still line up
+            idx = utt.lower().find(play_kw.lower())
+            kw_len = len(play_kw.lower())
+        phrase = utt[idx + kw_len:].strip() if idx >= 0 else utt.strip()
+        with self.lock:
+            cached = self._get_cached_resolution(message, phrase)
+        if cached:
+            # Repeat of a recent request; skip the query round-trip
+            LOG.info("Using cached resolution for: " + phrase)
+            self._start_playback(message, phrase, cached["skill_id"],
+                                 cached["callback_data"])
+            return
+
         LOG.info("Resolving Player for: "+phrase)
         # wait_while_speaking()
         # self.enclosure.mouth_think()
@@ -217,129 +328,139 @@ class PlaybackControlSkill(NeonSkill):
         # request.  The "callback_data" is optional, but can provide data
         # that eliminates the need to re-parse if this reply is chosen.
         #
-        self.query_replies[phrase] = []
-        self.query_extensions[phrase] = []
+        with self.lock:
+            self._start_query(phrase)
+            self._set_query_timeout(phrase, 1)
         self.bus.emit(message.forward('play:query', data={"phrase": phrase}))
 
-        self.schedule_event(self._play_query_timeout, 1,
-                            data={"phrase": phrase},
-                            name='PlayQueryTimeout')
-
     def handle_play_query_response(self, message):
+        data = message.data
+        search_phrase = data["phrase"]
         with self.lock:
-            search_phrase = message.data["phrase"]
-
-            if ("searching" in message.data and
-                    search_phrase in self.query_extensions):
+            extensions = self.query_extensions.get(search_phrase)
+            if "searching" in data and extensions is not None:
                 # Manage requests for time to complete searches
-                skill_id = message.data["skill_id"]
-                if message.data["searching"]:
+                skill_id = data["skill_id"]
+                if data["searching"]:
                     # extend the timeout by 5 seconds
-                    self.cancel_scheduled_event("PlayQueryTimeout")
-                    self.schedule_event(self._play_query_timeout, 5,
-                                        data={"phrase": search_phrase},
-                                        name='PlayQueryTimeout')
+                    self._set_query_timeout(search_phrase, 5)
 
                     # TODO: Perhaps block multiple extensions?
-                    if skill_id not in self.query_extensions[search_phrase]:
-                        self.query_extensions[search_phrase].append(skill_id)
+                    extensions.add(skill_id)
                 else:
                     # Search complete, don't wait on this skill any longer
-                    if skill_id in self.query_extensions[search_phrase]:
-                        self.query_extensions[search_phrase].remove(skill_id)
-                        if not self.query_extensions[search_phrase]:
-                            self.cancel_scheduled_event("PlayQueryTimeout")
-                            self.schedule_event(self._play_query_timeout, 1,
-                                                data={"phrase": search_phrase},
-                                                name='PlayQueryTimeout')
+                    if skill_id in extensions:
+                        extensions.remove(skill_id)
+                        if not extensions:
+                            self._set_query_timeout(search_phrase, 1)
 
             elif search_phrase in self.query_replies:
                 # Collect all replies until the timeout
-                self.query_replies[message.data["phrase"]].append(message.data)
+                self.query_replies[search_phrase].append(data)
 
-                skill_id = message.data["skill_id"]
+                skill_id = data["skill_id"]
                 # Search complete, don't wait on this skill any longer
-                if skill_id in self.query_extensions[search_phrase]:
-                    self.query_extensions[search_phrase].remove(skill_id)
-                    if not self.query_extensions[search_phrase]:
-                        self.cancel_scheduled_event("PlayQueryTimeout")
-                        self.schedule_event(self._play_query_timeout, 0,
-                                            data={"phrase": search_phrase},
-                                            name='PlayQueryTimeout')
+                if extensions is not None and skill_id in extensions:
+                    extensions.remove(skill_id)
+                    if not extensions:
+                        self._set_query_timeout(search_phrase, 0)
 
     def _play_query_timeout(self, message):
+        search_phrase = message.data["phrase"]
         with self.lock:
-            # Prevent any late-comers from retriggering this query handler
-            search_phrase = message.data["phrase"]
-            self.query_extensions[search_phrase] = []
-            # self.enclosure.mouth_reset()
-
-            # Look at any replies that arrived before the timeout
-            # Find response(s) with the highest confidence
-            best = None
-            ties = []
-            LOG.debug("CommonPlay Resolution: {}".format(search_phrase))
-            for handler in self.query_replies[search_phrase]:
-                LOG.debug("    {} using {}".format(handler["conf"],
-                                                   handler["skill_id"]))
-                if not best or handler["conf"] > best["conf"]:
-                    best = handler
-                    ties = []
-                elif handler["conf"] == best["conf"]:
-                    ties.append(handler)
-
-            if best:
-                if ties:
-                    # select randomly
-                    LOG.info("Skills tied, choosing randomly")
-                    skills = ties + [best]
-                    LOG.debug("Skills: " +
-                              str([s["skill_id"] for s in skills]))
-                    selected = random.choice(skills)
-                    # TODO: Ask user to pick between ties or do it
-                    # automagically
+            if search_phrase not in self.query_replies:
+                # Query was already resolved or dropped
+                return
+
+            # Wait longer if the timeout was extended after this was scheduled
+            remaining = (self._query_deadline.get(search_phrase, 0) -
+                         time.monotonic())
+            if remaining > QUERY_DEADLINE_EPSILON:
+                self.schedule_event(self._play_query_timeout, remaining,
+                                    data={"phrase": search_phrase},
+                                    name=self._query_timeout_name(
+                                        search_phrase))
+                self._scheduled_deadline[search_phrase] = \
+                    self._query_deadline[search_phrase]
+                return
+
+            try:
+                # Prevent any late-comers from retriggering this query handler
+                self.query_extensions[search_phrase] = set()
+                # self.enclosure.mouth_reset()
+
+                # Look at any replies that arrived before the timeout
+                # Find response(s) with the highest confidence
+                best_conf = None
+                best_list = []
+                LOG.debug("CommonPlay Resolution: {}".format(search_phrase))
+                for handler in self.query_replies[search_phrase]:
+                    conf = handler["conf"]
+                    LOG.debug("    {} using {}".format(conf,
+                                                       handler["skill_id"]))
+                    if best_conf is None or conf > best_conf:
+                        best_conf = conf
+                        best_list = [handler]
+                    elif conf == best_conf:
+                        best_list.append(handler)
+
+                if best_list:
+                    if len(best_list) == 1:
+                        selected = best_list[0]
+                    else:
+                        # select randomly
+                        import random
+                        LOG.info("Skills tied, choosing randomly")
+                        LOG.debug("Skills: " +
+                                  ", ".join(s["skill_id"] for s in best_list))
+                        selected = random.choice(best_list)
+                        # TODO: Ask user to pick between ties or do it
+                        # automagically
+
+                    # invoke best match
+                    skill_id = selected["skill_id"]
+                    callback_data = selected.get("callback_data")
+                    self._start_playback(message, search_phrase, skill_id,
+                                         callback_data)
+                    self._cache_resolution(message, search_phrase, skill_id,
+                                           callback_data)
+                # elif self.voc_match(search_phrase, "Music"):
+                #     self.speak_dialog("setup.hints")
                 else:
-                    selected = best
-
-                # invoke best match
-
-                # If skill specified it has its own gui, don't use the generic one
-                if not best.get("callback_data", {}).get("skill_gui", False):
-                    self.gui.show_page("controls.qml", override_idle=True)
-                LOG.info("Playing with: {}".format(selected["skill_id"]))
-                start_data = {"skill_id": selected["skill_id"],
-                              "phrase": search_phrase,
-                              "callback_data": selected.get("callback_data")}
-                self.bus.emit(message.forward('play:start', start_data))
-                self.has_played = True
-            # elif self.voc_match(search_phrase, "Music"):
-            #     self.speak_dialog("setup.hints")
-            else:
-                LOG.info("   No matches")
-
-                if self.neon_in_request(message):
-                    # Notify
-                    self.speak_dialog("cant.play", data={"phrase": search_phrase})
-
-            if search_phrase in self.query_replies:
-                del self.query_replies[search_phrase]
-            if search_phrase in self.query_extensions:
-                del self.query_extensions[search_phrase]
+                    LOG.info("   No matches")
+
+                    if self.neon_in_request(message):
+                        # Notify
+                        self.speak_dialog("cant.play",
+                                          data={"phrase": search_phrase})
+            finally:
+                if search_phrase in self.query_replies:
+                    del self.query_replies[search_phrase]
+                if search_phrase in self.query_extensions:
+                    del self.query_extensions[search_phrase]
+                self._query_deadline.pop(search_phrase, None)
+                self._scheduled_deadline.pop(search_phrase, None)
+
+    def _start_playback(self, message, phrase, skill_id, callback_data):
+        """Tell the selected skill to start playing the given phrase."""
+        # If skill specified it has its own gui, don't use the generic one
+        if not (callback_data or {}).get("skill_gui", False):
+            self.gui.show_page("controls.qml", override_idle=True)
+        LOG.info("Playing with: {}".format(skill_id))
+        start_data = {"skill_id": skill_id,
+                      "phrase": phrase,
+                      "callback_data": callback_data}
+        self.bus.emit(message.forward('play:start', start_data))
+        self.has_played = True
 
     def handle_song_info(self, message):
-        changed = False
-        for key in STATUS_KEYS:
-            val = message.data.get(key, '')
-            try:
-                changed = changed or self.gui[key] != val
-            except KeyError:
-                changed = True
-            self.gui[key] = val
-
-        if changed:
-            LOG.info('\n-->Track: {}\n-->Artist: {}\n-->Image: {}'
-                     ''.format(self.gui['track'], self.gui['artist'],
-                               self.gui['image']))
+        new = {k: message.data.get(k, '') for k in STATUS_KEYS}
+        if new != self._last_status:
+            for key, val in new.items():
+                self.gui[key] = val
+            self._last_status = new
+            LOG.info('\n-->Track: %s\n-->Artist: %s\n-->Image: %s',
+                     new['track'], new['artist'], new['image'])
 
 
 def create_skill():